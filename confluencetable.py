@@ -1,15 +1,199 @@
 from atlassian import Confluence
-import re
+from functools import lru_cache
+from html.entities import name2codepoint
+from lxml import etree
+from operator import itemgetter
+from typing import Any, Callable, Dict, Optional
+import os
+
+# Page bodies in Confluence storage format are XHTML fragments that use the ac: prefix for macros, the ri:
+# prefix for links and resources and the at: prefix for template variables, so they are wrapped in an element
+# declaring those namespaces before being parsed.
+# The wrapper also declares the XHTML entities (such as &nbsp;) in an internal DTD subset, since XML only
+# predefines &amp;, &lt;, &gt;, &quot; and &apos;.
+_STORAGE_NAMESPACES = {
+    'ac': 'http://www.atlassian.com/schema/confluence/4/ac/',
+    'ri': 'http://www.atlassian.com/schema/confluence/4/ri/',
+    'at': 'http://www.atlassian.com/schema/confluence/4/at/',
+}
+_STORAGE_OPEN = '<!DOCTYPE div [{}]><div {}>'.format(
+    ''.join('<!ENTITY {} "&#{};">'.format(name, codepoint) for name, codepoint in name2codepoint.items()
+            if name not in ('amp', 'lt', 'gt', 'quot', 'apos')),
+    ' '.join('xmlns:{}="{}"'.format(prefix, uri) for prefix, uri in _STORAGE_NAMESPACES.items()),
+)
+_STORAGE_CLOSE = '</div>'
+
+# XHTML elements that never have content. Every other empty XHTML element is written with an explicit end tag.
+_VOID_ELEMENTS = frozenset({
+    'area', 'base', 'br', 'col', 'embed', 'hr', 'img', 'input', 'link', 'meta', 'param', 'source', 'track', 'wbr',
+})
+
+# Finds the first table following the h1-h6 heading whose text matches $heading_text, treating
+# non-breaking spaces in both as ordinary spaces.
+_TABLE_XPATH = etree.XPath(
+    '(.//h1|.//h2|.//h3|.//h4|.//h5|.//h6)'
+    '[normalize-space(translate(., "\u00a0", " "))=normalize-space(translate($heading_text, "\u00a0", " "))][1]'
+    '/following-sibling::table[1]'
+)
+_ROWS_XPATH = etree.XPath('./thead/tr|./tbody/tr|./tr')
+_CELLS_XPATH = etree.XPath('./th|./td')
         
+@lru_cache(maxsize=1)
 def get_confluence_client():
     """
     Returns an instance of the Confluence client with the server URL and API token
-    obtained from environment variables.
+    obtained from environment variables. The client is created once and reused so
+    that its HTTP session and connections are kept alive between calls.
     """
     url = os.environ.get('CONFLUENCE_URL')
     token = os.environ.get('CONFLUENCE_TOKEN')
     username = os.environ.get('CONFLUENCE_USERNAME')
     return Confluence(url=url, username=username, password=token)
+
+def _parse_storage(body: str):
+    """
+    Parses a page body in Confluence storage format.
+
+    Args:
+        body (str): The value of the body.storage field of a page.
+
+    Returns:
+        lxml.etree._Element: An element wrapping the contents of the page body.
+    """
+    # strip_cdata is turned off so macro bodies are written back unchanged, and malformed storage raises
+    # an XMLSyntaxError instead of being rewritten. The wrapper and body are fed to the parser separately,
+    # which avoids building a concatenated copy of the body (lxml still encodes the body internally).
+    # A feed parser keeps the state of the document being fed to it, so a new parser is created for every
+    # call instead of sharing one at module level, where a parse that raised would leave it half-fed.
+    parser = etree.XMLParser(strip_cdata=False)
+    parser.feed(_STORAGE_OPEN)
+    parser.feed(body)
+    parser.feed(_STORAGE_CLOSE)
+    return parser.close()
+
+def _serialize_storage(root) -> str:
+    """
+    Serializes an element returned by _parse_storage back into Confluence storage format.
+
+    The markup is normalized rather than reproduced byte for byte: attributes are written with double quotes,
+    entities such as &nbsp; are written as the characters they stand for, and empty void elements and ac:, ri:
+    and at: elements are self-closed. Other empty elements, such as <td></td>, keep their end tags.
+
+    Args:
+        root (lxml.etree._Element): The element returned by _parse_storage.
+
+    Returns:
+        str: The page body, without the wrapping element.
+    """
+    # lxml self-closes every element without text or children, so give the empty ones that should keep their
+    # end tags empty text. This includes the wrapper, so it has an end tag even when the page is empty.
+    for element in root.iter(tag=etree.Element):
+        if element.text is None and len(element) == 0 and element.tag[0] != '{' and element.tag not in _VOID_ELEMENTS:
+            element.text = ''
+    # lxml serializes to UTF-8 either way, so the body is decoded once straight out of the serialized
+    # bytes instead of building a str of the whole document and then slicing a second copy out of it.
+    markup = etree.tostring(root, encoding='utf-8', xml_declaration=False)
+    return str(memoryview(markup)[markup.index(b'>') + 1:markup.rindex(b'<')], 'utf-8')
+
+def _find_table(root, heading_text: str):
+    """
+    Finds the table that comes after the heading with the specified text.
+
+    Args:
+        root (lxml.etree._Element): The element returned by _parse_storage.
+        heading_text (str): The text of the heading that comes before the table.
+
+    Returns:
+        Optional[lxml.etree._Element]: The table element, or None if the heading or table could not be found.
+    """
+    tables = _TABLE_XPATH(root, heading_text=heading_text)
+    return tables[0] if tables else None
+
+def _cell_text(cell) -> str:
+    """
+    Returns the text of a table cell, including the text of any nested elements, with surrounding whitespace removed.
+    """
+    return ''.join(cell.itertext()).strip()
+
+def _cell_span(cell, attribute: str) -> int:
+    """
+    Returns the colspan or rowspan of a table cell, which is 1 when the attribute is missing or invalid.
+    """
+    try:
+        return max(int(cell.get(attribute, 1)), 1)
+    except ValueError:
+        return 1
+
+def _layout_table(table):
+    """
+    Places the cells of a table on a grid of columns, taking colspan and rowspan into account.
+    The first row of the table holds the headers.
+
+    Args:
+        table (lxml.etree._Element): The table element returned by _find_table.
+
+    Returns:
+        Tuple[List[str], List[int], List[Tuple[lxml.etree._Element, Dict[int, lxml.etree._Element], Set[int], int]]]:
+            The table headers, the column each header starts in, and for each data row its <tr> element, its cells
+            keyed by the column they start in, the columns covered by a cell (including cells spanning down from
+            earlier rows) and the column after its last cell.
+    """
+    layout = []
+    # Maps each column covered by a rowspan to the number of further rows it covers
+    spans = {}
+    for row_element in _ROWS_XPATH(table):
+        occupied = set(spans)
+        spans = {column: count - 1 for column, count in spans.items() if count > 1}
+        cells = {}
+        column = 0
+        for cell in _CELLS_XPATH(row_element):
+            while column in occupied:
+                column += 1
+            colspan = _cell_span(cell, 'colspan')
+            rowspan = _cell_span(cell, 'rowspan')
+            cells[column] = cell
+            for spanned in range(column, column + colspan):
+                occupied.add(spanned)
+                if rowspan > 1:
+                    spans[spanned] = rowspan - 1
+            column += colspan
+        layout.append((row_element, cells, occupied, column))
+    if not layout:
+        return [], [], []
+    header_cells = layout[0][1]
+    header_columns = sorted(header_cells)
+    headers = [_cell_text(header_cells[column]) for column in header_columns]
+    return headers, header_columns, layout[1:]
+
+def _read_rows(headers, header_columns, layout):
+    """
+    Reads the rows of a table laid out by _layout_table. A row only has a value for the headers whose column
+    starts one of its cells, so columns covered by a merged cell are left out.
+
+    Returns:
+        List[Dict[str, str]]: A list of dictionaries representing the rows.
+    """
+    rows = []
+    for row_element, cells, occupied, end in layout:
+        row = {}
+        for header, column in zip(headers, header_columns):
+            if column in cells:
+                row[header] = _cell_text(cells[column])
+        rows.append(row)
+    return rows
+
+def _parse_table(table):
+    """
+    Parses the headers and rows out of a table element. The first row of the table holds the headers.
+
+    Args:
+        table (lxml.etree._Element): The table element returned by _find_table.
+
+    Returns:
+        Tuple[List[str], List[Dict[str, str]]]: The table headers and a list of dictionaries representing the rows.
+    """
+    headers, header_columns, layout = _layout_table(table)
+    return headers, _read_rows(headers, header_columns, layout)
     
 def get_table_data(page_title: str, heading_text: str):
     """
@@ -20,22 +204,20 @@ def get_table_data(page_title: str, heading_text: str):
         heading_text (str): The text of the heading that comes before the table.
 
     Returns:
-        List[Dict[str, Any]]: A list of dictionaries representing the rows in the table.
+        Tuple[Dict[str, Any], Optional[List[Dict[str, Any]]]]: The page data returned by Confluence, which can be
+            passed on to update_confluence_table to avoid fetching the page again, and a list of dictionaries
+            representing the rows in the table, or None if the heading or table could not be found.
     """
     confluence = get_confluence_client()
-    page_data = confluence.get_page_by_title(space='MY_SPACE', title=page_title, expand='body.storage', representation='wiki')
-    heading_match = re.search(fr"(^|\n)h[1-6]\. {re.escape(heading_text)}\s*\n", page_data['body']['storage']['value'])
-    if not heading_match:
-        return None
-    table_match = re.search(r'\|\s*(.*?)\s*\|\|.*?\n((?:\|\s*.*?\s*\|\|.*?\n)+)', page_data['body']['storage']['value'][heading_match.end():], re.DOTALL)
-    if not table_match:
-        return None
-    headers = [header.strip() for header in table_match.group(1).split('|') if header.strip()]
-    rows = [dict(zip(headers, [value.strip() for value in row.split('|') if value.strip()])) for row in table_match.group(2).split('\n') if row.strip()]
-    return rows
+    page_data = confluence.get_page_by_title(space='MY_SPACE', title=page_title, expand='body.storage,version')
+    table = _find_table(_parse_storage(page_data['body']['storage']['value']), heading_text)
+    if table is None:
+        return page_data, None
+    headers, rows = _parse_table(table)
+    return page_data, rows
 
     
-def update_confluence_table(space: str, page_title: str, heading_text: str, update_fn: Callable[[dict], dict]):
+def update_confluence_table(space: str, page_title: str, heading_text: str, update_fn: Callable[[dict], dict], page_data: Optional[Dict[str, Any]] = None):
     """
     Update a table on a Confluence page.
 
@@ -45,47 +227,91 @@ def update_confluence_table(space: str, page_title: str, heading_text: str, upda
     heading_text (str): The heading text that comes before the table.
     update_fn (Callable[[dict], dict]): A function that takes a dictionary representing a row in the table as input,
         modifies it as needed, and returns the modified dictionary.
+    page_data (Optional[Dict[str, Any]]): The page data previously returned by get_table_data. If provided,
+        the page is not fetched again before it is updated, and space and page_title are ignored. The page data
+        is updated in place with the new body and version after a successful update, so the same dictionary can
+        be passed to further calls for the same page.
 
     Returns:
     None
     """
-    # Retrieve the page content using the get_page_by_title method
-    page_data = confluence.get_page_by_title(space=space, title=page_title, expand='body.storage', representation='wiki')
-
-    # Search for the heading text using regular expressions
-    heading_match = re.search(r'(^|\n)h[1-6]\. {}\s*\n'.format(re.escape(heading_text)), page_data['body']['storage']['value'])
-    if heading_match:
-        # Search for the table after the heading using regular expressions
-        table_match = re.search(r'\|\s*(.*?)\s*\|\|.*?\n((?:\|\s*.*?\s*\|\|.*?\n)+)', page_data['body']['storage']['value'][heading_match.end():], re.DOTALL)
-        if table_match:
-            headers = [header.strip() for header in table_match.group(1).split('|') if header.strip()]
-            rows = [dict(zip(headers, [value.strip() for value in row.split('|') if value.strip()] )) for row in table_match.group(2).split('\n') if row.strip()]
-
-            # Apply the update function to each row in the table
-            for row in rows:
-                updated_row = update_fn(row)
-                row.update(updated_row)
-
-            # Convert the list of dictionaries back into Wiki markup format
-            table_markup = '||{}||\n{}'.format(
-                '||'.join(headers),
-                '\n'.join(['|{}|'.format('|'.join([row.get(header, '') for header in headers])) for row in rows])
-            )
-
-            # Update the page content with the modified table data
-            # This command is quite involved so here's some more context
-            # page_data['body']['storage']['value']: This retrieves the current value of the body.storage.value field of the page_data dictionary. This field contains the page content in Wiki markup format.
-            # [:heading_match.end()]: This slices the page content up to the end of the heading that precedes the table. This ensures that any content that comes before the table is preserved, while any content that comes after the table is removed.
-            # +: This concatenates the sliced content with the modified table data.
-            # re.sub(r'\|\s*(.*?)\s*\|\|.*?\n((?:\|\s*.*?\s*\|\|.*?\n)+)', table_markup, page_data['body']['storage']['value'][heading_match.end():], 1, re.DOTALL): This replaces the table data in the page content with the modified table data using a regular expression substitution. Here's what each part of the regular expression means:
-            ## \|\s*(.*?)\s*\|\|: This matches the header row of the table in Wiki markup format. The .*? inside the parentheses captures the text of each header cell.
-            ## .*?\n: This matches the separator row of the table in Wiki markup format.
-            ## ((?:\|\s*.*?\s*\|\|.*?\n)+): This matches one or more rows of the table in Wiki markup format. The (?:...) syntax creates a non-capturing group that matches a single row of the table. The | inside the group matches the cell separator. The .*? matches the text of each cell. The + outside the group matches one or more rows.
-            # The re.DOTALL flag at the end of the regular expression causes the . character to match any character, including newlines.
-            # The table_markup argument to re.sub is the modified table data, which will replace the matched table data in the page content.
-            # The 1 argument to re.sub tells the method to perform at most one substitution. This ensures that only the first occurrence of the table is modified, even if there are multiple tables on the page.
-            page_data['body']['storage']['value'] = page_data['body']['storage']['value'][:heading_match.end()] + re.sub(r'\|\s*(.*?)\s*\|\|.*?\n((?:\|\s*.*?\s*\|\|.*?\n)+)', table_markup, page_data['body']['storage']['value'][heading_match.end():], 1, re.DOTALL)
-            confluence.update_page_by_id(page_data['id'], data=page_data)
+    # Retrieve the page content using the get_page_by_title method, unless the caller already has it
+    confluence = get_confluence_client()
+    if page_data is None:
+        page_data = confluence.get_page_by_title(space=space, title=page_title, expand='body.storage,version')
+
+    # Parse the page content and search for the table after the heading
+    root = _parse_storage(page_data['body']['storage']['value'])
+    table = _find_table(root, heading_text)
+    if table is not None:
+        headers, header_columns, layout = _layout_table(table)
+        rows = _read_rows(headers, header_columns, layout)
+
+        # Apply the update function to each row in the table
+        for row in rows:
+            updated_row = update_fn(row)
+            row.update(updated_row)
+
+        # Write the updated rows back into the table
+        # The page content is in Confluence storage format, which is XHTML, so the table is a <table> element
+        # with one <tr> element per row. The first row holds the <th> header cells and the remaining rows hold
+        # the <td> data cells, in the same order as rows. Each value is written to the cell that starts in its
+        # header's column, as laid out by _layout_table.
+        # Only cells whose text has changed are rewritten, so any formatting in the other cells is preserved.
+        # A rewritten cell loses its nested markup (such as <p> elements) and just holds the new text.
+        # The headers are the same for every row, so the values of each row are fetched with a single itemgetter
+        # call, falling back to dict.get only for rows that are missing a header. None is written as an empty cell.
+        get_values = itemgetter(*headers) if len(headers) > 1 else lambda row: tuple(row[header] for header in headers)
+        last_column = header_columns[-1] if header_columns else -1
+        changed = False
+        for (row_element, cells, occupied, end), row in zip(layout, rows):
+            try:
+                values = get_values(row)
+            except KeyError:
+                values = tuple(row.get(header, '') for header in headers)
+            # Columns after the last cell of a row that no merged cell covers get empty <td> elements
+            for column in range(end, last_column + 1):
+                if column not in occupied:
+                    cells[column] = etree.SubElement(row_element, 'td')
+            for header, column, value in zip(headers, header_columns, values):
+                value = '' if value is None else str(value)
+                cell = cells.get(column)
+                if cell is None:
+                    # The column is covered by a cell merged in from another column or row
+                    if value.strip():
+                        raise ValueError('Cannot set {!r}: the cell is merged with another cell'.format(header))
+                    continue
+                # _cell_text strips surrounding whitespace, so the new value is compared the same way
+                if _cell_text(cell) != value.strip():
+                    for child in list(cell):
+                        cell.remove(child)
+                    cell.text = value
+                    changed = True
+
+        # Skip the update entirely when the update function left every cell as it was
+        if not changed:
+            return
+
+        # Update the page content with the modified table data
+        # The rest of the page keeps its content and structure, but is normalized as described in _serialize_storage.
+        # The page is updated through the REST API directly so that the version sent is one more than the version
+        # that was fetched. Confluence rejects an update whose version is not exactly one more than the current
+        # version with a 409 Conflict, so if the page has been edited since it was fetched the update raises instead
+        # of silently overwriting the other edit.
+        body = _serialize_storage(root)
+        version = page_data['version']['number'] + 1
+        confluence.put(
+            'rest/api/content/{}'.format(page_data['id']),
+            data={
+                'id': page_data['id'],
+                'type': 'page',
+                'title': page_data['title'],
+                'version': {'number': version},
+                'body': {'storage': {'value': body, 'representation': 'storage'}},
+            },
+        )
+        page_data['body']['storage']['value'] = body
+        page_data['version'] = {'number': version}
             
 def main():
     # Set up Confluence client
@@ -94,14 +320,14 @@ def main():
     # Get data from Confluence table
     page_title = "My Confluence Page"
     heading_text = "My Table Heading"
-    table_data = get_table_data(page_title, heading_text)
+    page_data, table_data = get_table_data(page_title, heading_text)
 
     # Update the table data
     def update_fn(row: Dict[str, Any]) -> Dict[str, Any]:
         row["Status"] = "Completed"
         return row
 
-    update_confluence_table("MY_SPACE", page_title, heading_text, update_fn)
+    update_confluence_table("MY_SPACE", page_title, heading_text, update_fn, page_data=page_data)
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -0,0 +1,211 @@
+import pytest
+from lxml import etree
+
+import confluencetable
+
+
+def roundtrip(body):
+    return confluencetable._serialize_storage(confluencetable._parse_storage(body))
+
+
+def test_storage_roundtrip_keeps_entities():
+    assert roundtrip('<p>a&nbsp;b &amp; c</p>') == '<p>a\xa0b &amp; c</p>'
+    assert roundtrip('<p>&nbsp;x</p><p>&amp;</p>') == '<p>\xa0x</p><p>&amp;</p>'
+    assert roundtrip('<p>&lt;b&gt; &eacute;</p>') == '<p>&lt;b&gt; é</p>'
+
+
+def test_storage_roundtrip_keeps_empty_elements_open():
+    assert roundtrip("<p class='c'></p><p>a<br/>b</p>") == '<p class="c"></p><p>a<br/>b</p>'
+
+
+def test_storage_roundtrip_keeps_macros_and_links():
+    body = (
+        '<ac:structured-macro ac:name="code"><ac:plain-text-body><![CDATA[if a < b && c:]]>'
+        '</ac:plain-text-body></ac:structured-macro>'
+        '<p><ac:link><ri:page ri:content-title="Other Page"/></ac:link></p>'
+    )
+    assert roundtrip(body) == body
+
+
+def test_storage_roundtrip_keeps_template_variables():
+    body = '<p><at:var at:name="x"/></p>'
+    assert roundtrip(body) == body
+
+
+def test_storage_roundtrip_empty_body():
+    assert roundtrip('') == ''
+
+
+def test_parse_storage_rejects_malformed_body():
+    with pytest.raises(etree.XMLSyntaxError):
+        confluencetable._parse_storage('<p>unclosed')
+
+
+def test_find_table_with_nbsp_in_heading():
+    root = confluencetable._parse_storage(
+        '<h2>My&nbsp;Heading</h2><table><tbody><tr><th>A</th></tr><tr><td>x&nbsp;y</td></tr></tbody></table>'
+    )
+    table = confluencetable._find_table(root, 'My Heading')
+    assert confluencetable._parse_table(table) == (['A'], [{'A': 'x\xa0y'}])
+    assert confluencetable._find_table(root, 'My\xa0Heading') is table
+
+
+class FakeConfluence:
+    def __init__(self, body):
+        self.page = {
+            'id': '42',
+            'title': 'My Page',
+            'version': {'number': 3},
+            'body': {'storage': {'value': body, 'representation': 'storage'}},
+        }
+        self.updates = []
+        self.versions = []
+
+    def get_page_by_title(self, space, title, expand=None):
+        return self.page
+
+    def put(self, path, data):
+        assert path == 'rest/api/content/42'
+        self.updates.append(data['body']['storage']['value'])
+        self.versions.append(data['version']['number'])
+
+
+def update(monkeypatch, body, update_fn):
+    confluence = FakeConfluence(body)
+    monkeypatch.setattr(confluencetable, 'get_confluence_client', lambda: confluence)
+    confluencetable.update_confluence_table('MY_SPACE', 'My Page', 'Tasks', update_fn)
+    return confluence
+
+
+def test_update_appends_missing_cells(monkeypatch):
+    body = '<h2>Tasks</h2><table><tbody><tr><th>Name</th><th>Status</th></tr><tr><td>B</td></tr></tbody></table>'
+
+    def update_fn(row):
+        row['Status'] = 'Done'
+        return row
+
+    assert update(monkeypatch, body, update_fn).updates == [
+        '<h2>Tasks</h2><table><tbody><tr><th>Name</th><th>Status</th></tr><tr><td>B</td><td>Done</td></tr></tbody></table>'
+    ]
+
+
+def test_update_writes_none_as_empty_cell(monkeypatch):
+    body = '<h2>Tasks</h2><table><tbody><tr><th>Name</th><th>Status</th></tr><tr><td>B</td><td>Open</td></tr></tbody></table>'
+
+    def update_fn(row):
+        row['Status'] = None
+        return row
+
+    assert update(monkeypatch, body, update_fn).updates == [
+        '<h2>Tasks</h2><table><tbody><tr><th>Name</th><th>Status</th></tr><tr><td>B</td><td></td></tr></tbody></table>'
+    ]
+
+
+def test_update_sends_next_version(monkeypatch):
+    body = '<h2>Tasks</h2><table><tbody><tr><th>Name</th><th>Status</th></tr><tr><td>B</td><td>Open</td></tr></tbody></table>'
+
+    def update_fn(row):
+        row['Status'] = 'Done'
+        return row
+
+    confluence = update(monkeypatch, body, update_fn)
+    assert confluence.versions == [4]
+    assert confluence.page['version'] == {'number': 4}
+
+
+def test_update_skips_unchanged_table(monkeypatch):
+    body = '<h2>Tasks</h2><table><tbody><tr><th>Name</th><th>Status</th></tr><tr><td>B</td><td><p>Open</p></td></tr></tbody></table>'
+
+    def update_fn(row):
+        row['Status'] = ' Open'
+        return row
+
+    assert update(monkeypatch, body, update_fn).updates == []
+
+
+def test_update_reuses_page_data_across_calls(monkeypatch):
+    body = '<h2>Tasks</h2><table><tbody><tr><th>Name</th><th>Status</th></tr><tr><td>B</td><td>Open</td></tr></tbody></table>'
+    confluence = FakeConfluence(body)
+    monkeypatch.setattr(confluencetable, 'get_confluence_client', lambda: confluence)
+    page_data, rows = confluencetable.get_table_data('My Page', 'Tasks')
+    assert rows == [{'Name': 'B', 'Status': 'Open'}]
+
+    for status in ('Doing', 'Done'):
+        def update_fn(row):
+            row['Status'] = status
+            return row
+
+        confluencetable.update_confluence_table('MY_SPACE', 'My Page', 'Tasks', update_fn, page_data=page_data)
+
+    assert confluence.versions == [4, 5]
+    assert page_data['body']['storage']['value'].endswith('<td>B</td><td>Done</td></tr></tbody></table>')
+
+
+def test_update_keeps_empty_cells_elsewhere_open(monkeypatch):
+    other = '<h2>Other</h2><table><tbody><tr><th>A</th></tr><tr><td></td></tr></tbody></table>'
+    body = other + '<h2>Tasks</h2><table><tbody><tr><th>Name</th><th>Status</th></tr><tr><td>B</td><td>Open</td></tr></tbody></table>'
+
+    def update_fn(row):
+        row['Status'] = 'Done'
+        return row
+
+    assert update(monkeypatch, body, update_fn).updates == [
+        other + '<h2>Tasks</h2><table><tbody><tr><th>Name</th><th>Status</th></tr><tr><td>B</td><td>Done</td></tr></tbody></table>'
+    ]
+
+
+def test_parse_table_with_rowspan():
+    root = confluencetable._parse_storage(
+        '<h2>Tasks</h2><table><tbody><tr><th>A</th><th>B</th></tr>'
+        '<tr><td rowspan="2">1</td><td>x</td></tr><tr><td>2</td></tr></tbody></table>'
+    )
+    table = confluencetable._find_table(root, 'Tasks')
+    assert confluencetable._parse_table(table) == (['A', 'B'], [{'A': '1', 'B': 'x'}, {'B': '2'}])
+
+
+def test_update_with_rowspan(monkeypatch):
+    body = (
+        '<h2>Tasks</h2><table><tbody><tr><th>Name</th><th>Status</th></tr>'
+        '<tr><td rowspan="2">A</td><td>Open</td></tr><tr><td>Open</td></tr></tbody></table>'
+    )
+
+    def update_fn(row):
+        row['Status'] = 'Done'
+        return row
+
+    assert update(monkeypatch, body, update_fn).updates == [
+        '<h2>Tasks</h2><table><tbody><tr><th>Name</th><th>Status</th></tr>'
+        '<tr><td rowspan="2">A</td><td>Done</td></tr><tr><td>Done</td></tr></tbody></table>'
+    ]
+
+
+def test_update_with_colspan(monkeypatch):
+    merged = '<tr><td>A</td><td colspan="2">blocked</td></tr>'
+    body = (
+        '<h2>Tasks</h2><table><tbody><tr><th>Name</th><th>Status</th><th>Owner</th></tr>'
+        + merged + '<tr><td>B</td><td>Open</td><td>x</td></tr></tbody></table>'
+    )
+
+    def update_fn(row):
+        if row['Name'] == 'B':
+            row['Status'] = 'Done'
+        return row
+
+    assert update(monkeypatch, body, update_fn).updates == [
+        '<h2>Tasks</h2><table><tbody><tr><th>Name</th><th>Status</th><th>Owner</th></tr>'
+        + merged + '<tr><td>B</td><td>Done</td><td>x</td></tr></tbody></table>'
+    ]
+
+
+def test_update_rejects_value_for_merged_cell(monkeypatch):
+    body = (
+        '<h2>Tasks</h2><table><tbody><tr><th>Name</th><th>Status</th><th>Owner</th></tr>'
+        '<tr><td>A</td><td colspan="2">blocked</td></tr></tbody></table>'
+    )
+
+    def update_fn(row):
+        row['Owner'] = 'me'
+        return row
+
+    with pytest.raises(ValueError):
+        update(monkeypatch, body, update_fn)